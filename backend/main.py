@@ -1,23 +1,30 @@
-from fastapi import FastAPI, HTTPException, Depends, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, HTTPException, Depends, Query as QueryParam, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 import strawberry
 from strawberry.fastapi import GraphQLRouter
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Boolean, Text
+from sqlalchemy import select, text, tuple_, Column, Index, Integer, String, DateTime, Boolean, Text
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.exc import DataError, IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, Session
-from kafka import KafkaProducer, KafkaConsumer
-from elasticsearch import Elasticsearch
+from aiokafka import AIOKafkaProducer
+from elasticsearch import AsyncElasticsearch
+from elasticsearch.helpers import async_bulk
 import asyncio
+import dataclasses
 import json
 import logging
-from datetime import datetime
-from typing import List, Optional
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Set, Tuple, Union
 import os
 import aiofiles
 import httpx
+import orjson
+import redis.asyncio as redis
 from web3 import Web3
-import ipfshttpclient
 from pydantic import BaseModel
 
 # Configuration
@@ -26,9 +33,113 @@ ELASTICSEARCH_URL = os.getenv("ELASTICSEARCH_URL", "http://localhost:9200")
 KAFKA_BOOTSTRAP_SERVERS = os.getenv("KAFKA_BOOTSTRAP_SERVERS", "localhost:9092")
 ETHEREUM_RPC_URL = os.getenv("ETHEREUM_RPC_URL", "http://localhost:8545")
 IPFS_API_URL = os.getenv("IPFS_API_URL", "http://localhost:5001")
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
+BROADCAST_CHANNEL = "audit-events-broadcast"
+# Advisory lock key held while a worker creates the schema
+SCHEMA_LOCK_KEY = 727_001
+
+def dumps_json(obj) -> bytes:
+    """Encode with orjson, falling back to the stdlib for what it refuses.
+
+    orjson rejects integers beyond 64 bits, which are valid JSON and which
+    Postgres jsonb stores fine.
+    """
+    try:
+        return orjson.dumps(obj)
+    except orjson.JSONEncodeError:
+        return json.dumps(obj).encode()
+
+# Async service clients, started and stopped with the application
+kafka_producer: Optional[AIOKafkaProducer] = None
+es: Optional[AsyncElasticsearch] = None
+ipfs_client: Optional[httpx.AsyncClient] = None
+# Pub/sub bus that carries WebSocket broadcasts to every worker process
+broadcast_bus: Optional[redis.Redis] = None
+# Documents waiting to be sent to Elasticsearch in the next _bulk request
+es_index_queue: asyncio.Queue = asyncio.Queue(maxsize=10000)
+# (AuditRecord, Future) pairs waiting to be inserted by the next batched commit
+db_write_queue: asyncio.Queue = asyncio.Queue(maxsize=10000)
+# (payload, Future) pairs waiting to be added to IPFS in the next multi-file add
+ipfs_add_queue: asyncio.Queue = asyncio.Queue(maxsize=10000)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global kafka_producer, es, ipfs_client, broadcast_bus
+    async with engine.begin() as conn:
+        # Every worker process runs this on startup. Serialize them so only the
+        # first creates tables and indexes; the rest then find them in place.
+        await conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": SCHEMA_LOCK_KEY})
+        await conn.run_sync(Base.metadata.create_all)
+    db_write_task = asyncio.create_task(db_write_worker())
+
+    try:
+        # Batch and compress on the client: events linger for up to 100ms so a
+        # single Produce request carries many of them. max_batch_size must stay
+        # below the broker's message.max.bytes (1MB by default). This topic is
+        # the audit trail, so wait for all in-sync replicas and let the
+        # idempotent producer retry batches without duplicating or reordering.
+        kafka_producer = AIOKafkaProducer(
+            bootstrap_servers=KAFKA_BOOTSTRAP_SERVERS,
+            linger_ms=100,
+            max_batch_size=1024 * 1024,
+            compression_type='lz4',
+            acks='all',
+            enable_idempotence=True
+        )
+        await kafka_producer.start()
+    except Exception as e:
+        logging.error(f"Failed to start Kafka producer: {e}")
+        kafka_producer = None
+
+    es_bulk_task = None
+    try:
+        es = AsyncElasticsearch([ELASTICSEARCH_URL])
+        es_bulk_task = asyncio.create_task(bulk_index_worker())
+        await configure_audit_index()
+    except Exception as e:
+        logging.error(f"Failed to configure Elasticsearch: {e}")
+
+    ipfs_client = httpx.AsyncClient(base_url=IPFS_API_URL, timeout=30)
+    ipfs_add_task = asyncio.create_task(ipfs_add_worker())
+
+    relay_task = None
+    try:
+        broadcast_bus = redis.from_url(REDIS_URL)
+        await broadcast_bus.ping()
+        relay_task = asyncio.create_task(relay_broadcasts())
+    except Exception as e:
+        logging.error(f"Failed to connect to Redis, broadcasts will only reach this worker's clients: {e}")
+        broadcast_bus = None
+
+    # Probe once before serving, since create_event relies on the IPFS status
+    await update_service_status()
+    health_task = asyncio.create_task(refresh_service_status())
+
+    yield
+
+    health_task.cancel()
+    if relay_task:
+        relay_task.cancel()
+    if broadcast_bus:
+        await broadcast_bus.aclose()
+    await stop_worker(ipfs_add_task, ipfs_add_queue)
+    await ipfs_client.aclose()
+    await stop_worker(db_write_task, db_write_queue)
+    if kafka_producer:
+        await kafka_producer.stop()
+    if es_bulk_task:
+        await stop_worker(es_bulk_task, es_index_queue)
+    if es:
+        await es.close()
+    await engine.dispose()
 
 # Initialize services
-app = FastAPI(title="Analytics & Blockchain Audit Pipeline", version="1.0.0")
+app = FastAPI(
+    title="Analytics & Blockchain Audit Pipeline",
+    version="1.0.0",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan
+)
 security = HTTPBearer()
 
 # CORS middleware
@@ -41,26 +152,59 @@ app.add_middleware(
 )
 
 # Database setup
-engine = create_engine(DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+engine = create_async_engine(
+    DATABASE_URL.replace("postgresql://", "postgresql+asyncpg://", 1),
+    pool_size=20,
+    max_overflow=10,
+    pool_pre_ping=True,
+    pool_recycle=3600,
+    json_serializer=lambda obj: dumps_json(obj).decode(),
+    json_deserializer=orjson.loads
+)
+SessionLocal = async_sessionmaker(engine, expire_on_commit=False)
 Base = declarative_base()
 
 class AuditRecord(Base):
     __tablename__ = "audit_records"
     
-    id = Column(Integer, primary_key=True, index=True)
-    event_type = Column(String, index=True)
-    user_id = Column(String, index=True)
+    id = Column(Integer, primary_key=True)
+    event_type = Column(String)
+    user_id = Column(String)
     action = Column(Text)
     timestamp = Column(DateTime, default=datetime.utcnow)
-    transaction_hash = Column(String, unique=True)
+    transaction_hash = Column(String)
     block_number = Column(Integer)
     ipfs_hash = Column(String)
     verified = Column(Boolean, default=False)
     gas_used = Column(Integer)
-    metadata = Column(Text)
-
-Base.metadata.create_all(bind=engine)
+    # "metadata" is reserved on declarative classes, so only the column uses it
+    metadata_ = Column("metadata", JSONB)
+
+# Serve newest-first listing and keyset pagination as index range scans, with
+# or without the event_type / user_id filters. The composite indexes also
+# cover plain equality lookups on their leading column.
+Index("ix_audit_records_ts_id", AuditRecord.timestamp.desc(), AuditRecord.id.desc())
+Index("ix_audit_user_ts", AuditRecord.user_id, AuditRecord.timestamp.desc(), AuditRecord.id.desc())
+Index("ix_audit_etype_ts", AuditRecord.event_type, AuditRecord.timestamp.desc(), AuditRecord.id.desc())
+Index("ix_audit_records_transaction_hash", AuditRecord.transaction_hash, unique=True)
+
+def keyset_cursor(before_timestamp: Optional[datetime], before_id: Optional[int]) -> Optional[Tuple[datetime, int]]:
+    """Build the (timestamp, id) cursor for newest_first from request parameters."""
+    if (before_timestamp is None) != (before_id is None):
+        raise ValueError("before_timestamp and before_id must be given together")
+    if before_timestamp is None:
+        return None
+    # timestamp is stored as naive UTC, which Postgres won't compare with an
+    # aware value, so bring offsets like "...Z" or "+02:00" back to UTC first
+    if before_timestamp.tzinfo is not None:
+        before_timestamp = before_timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return (before_timestamp, before_id)
+
+def newest_first(query, before: Optional[Tuple[datetime, int]] = None):
+    """Order records newest first, starting after the (timestamp, id) cursor if given."""
+    if before:
+        query = query.where(tuple_(AuditRecord.timestamp, AuditRecord.id) < tuple_(*before))
+    return query.order_by(AuditRecord.timestamp.desc(), AuditRecord.id.desc())
 
 # Pydantic models
 class EventModel(BaseModel):
@@ -81,25 +225,58 @@ class AuditRecordResponse(BaseModel):
     verified: bool
     gas_used: Optional[int]
 
+# List endpoints select just these columns instead of whole ORM entities
+RESPONSE_COLUMNS = [getattr(AuditRecord, name) for name in AuditRecordResponse.model_fields]
+
 # Services initialization
 try:
-    kafka_producer = KafkaProducer(
-        bootstrap_servers=[KAFKA_BOOTSTRAP_SERVERS],
-        value_serializer=lambda v: json.dumps(v).encode('utf-8')
-    )
-    
-    es = Elasticsearch([ELASTICSEARCH_URL])
-    
     w3 = Web3(Web3.HTTPProvider(ETHEREUM_RPC_URL))
     
-    ipfs_client = ipfshttpclient.connect(IPFS_API_URL)
-    
 except Exception as e:
     logging.error(f"Failed to initialize services: {e}")
-    kafka_producer = None
-    es = None
     w3 = None
-    ipfs_client = None
+
+# Elasticsearch search
+SEARCH_TEMPLATE_ID = "audit-records-search"
+
+# Stored in the cluster once, so a search only sends its parameters. Hits are
+# ranked by score with id as a tiebreaker, which gives search_after a stable
+# position to resume from. Exact hit counts are not needed and are expensive on
+# a large index, so they are not tracked.
+SEARCH_TEMPLATE_SOURCE = """{
+  "query": {
+    "multi_match": {
+      "query": {{#toJson}}query{{/toJson}},
+      "fields": ["event_type", "user_id", "action"]
+    }
+  },
+  "size": {{size}},
+  "sort": [{"_score": "desc"}, {"id": {"order": "desc", "unmapped_type": "long"}}],
+  {{#after_id}}"search_after": [{{after_score}}, {{after_id}}],{{/after_id}}
+  "track_total_hits": false,
+  "_source": ["id", "event_type", "user_id", "action", "timestamp", "ipfs_hash"]
+}"""
+
+search_template_stored = False
+
+async def store_search_template():
+    global search_template_stored
+    if not search_template_stored:
+        await es.put_script(
+            id=SEARCH_TEMPLATE_ID,
+            script={"lang": "mustache", "source": SEARCH_TEMPLATE_SOURCE}
+        )
+        search_template_stored = True
+
+async def search_audit_index(query: str, size: int, search_after: Optional[list] = None) -> list:
+    # Stored at startup; retried here in case Elasticsearch was down then
+    await store_search_template()
+
+    params = {"query": query, "size": size}
+    if search_after:
+        params["after_score"], params["after_id"] = search_after
+    response = await es.search_template(index="audit_records", id=SEARCH_TEMPLATE_ID, params=params)
+    return response['hits']['hits']
 
 # GraphQL schema
 @strawberry.type
@@ -109,43 +286,41 @@ class AuditRecordType:
     user_id: str
     action: str
     timestamp: datetime
-    transaction_hash: Optional[str]
-    block_number: Optional[int]
-    ipfs_hash: Optional[str]
-    verified: bool
+    # Search hits only carry the indexed fields, so these may be left unset
+    transaction_hash: Optional[str] = None
+    block_number: Optional[int] = None
+    ipfs_hash: Optional[str] = None
+    verified: bool = False
+
+RECORD_TYPE_COLUMNS = [getattr(AuditRecord, field.name) for field in dataclasses.fields(AuditRecordType)]
 
 @strawberry.type
 class Query:
     @strawberry.field
-    def audit_records(self, limit: int = 50) -> List[AuditRecordType]:
-        db = SessionLocal()
-        try:
-            records = db.query(AuditRecord).order_by(AuditRecord.timestamp.desc()).limit(limit).all()
-            return [AuditRecordType(**record.__dict__) for record in records]
-        finally:
-            db.close()
+    async def audit_records(
+        self,
+        limit: int = 50,
+        before_timestamp: Optional[datetime] = None,
+        before_id: Optional[int] = None
+    ) -> List[AuditRecordType]:
+        before = keyset_cursor(before_timestamp, before_id)
+
+        async with SessionLocal() as db:
+            result = await db.execute(
+                newest_first(select(*RECORD_TYPE_COLUMNS), before).limit(limit)
+            )
+            return [AuditRecordType(**row._mapping) for row in result]
 
     @strawberry.field
-    def search_records(self, query: str) -> List[AuditRecordType]:
+    async def search_records(self, query: str, limit: int = 10) -> List[AuditRecordType]:
         if not es:
             return []
         
         try:
-            response = es.search(
-                index="audit_records",
-                body={
-                    "query": {
-                        "multi_match": {
-                            "query": query,
-                            "fields": ["event_type", "user_id", "action"]
-                        }
-                    }
-                }
-            )
-            
             records = []
-            for hit in response['hits']['hits']:
+            for hit in await search_audit_index(query, limit):
                 source = hit['_source']
+                source['timestamp'] = datetime.fromisoformat(source['timestamp'])
                 records.append(AuditRecordType(**source))
             return records
         except Exception as e:
@@ -156,37 +331,354 @@ schema = strawberry.Schema(query=Query)
 graphql_app = GraphQLRouter(schema)
 
 # Dependency
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 # WebSocket manager
 class ConnectionManager:
-    def __init__(self):
-        self.active_connections: List[WebSocket] = []
+    def __init__(self, max_queued_messages: int = 1000):
+        # Each socket gets its own bounded outbox drained by its own writer
+        # task, so a slow client only ever holds up itself.
+        self.active_connections: Dict[WebSocket, asyncio.Queue] = {}
+        self.writers: Dict[WebSocket, asyncio.Task] = {}
+        # Close handshakes with dropped clients, held so they aren't collected
+        self.closers: Set[asyncio.Task] = set()
+        self.max_queued_messages = max_queued_messages
 
     async def connect(self, websocket: WebSocket):
         await websocket.accept()
-        self.active_connections.append(websocket)
+        queue = asyncio.Queue(maxsize=self.max_queued_messages)
+        self.active_connections[websocket] = queue
+        self.writers[websocket] = asyncio.create_task(self._write(websocket, queue))
 
     def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
+        self.active_connections.pop(websocket, None)
+        writer = self.writers.pop(websocket, None)
+        if writer and writer is not asyncio.current_task():
+            writer.cancel()
+
+    async def _write(self, websocket: WebSocket, queue: asyncio.Queue):
+        try:
+            while True:
+                message = await queue.get()
+                if isinstance(message, bytes):
+                    await websocket.send_bytes(message)
+                else:
+                    await websocket.send_text(message)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.disconnect(websocket)
+
+    async def _close(self, websocket: WebSocket, code: int):
+        try:
+            await websocket.close(code=code)
+        except Exception:
+            pass
 
     async def send_personal_message(self, message: str, websocket: WebSocket):
-        await websocket.send_text(message)
+        queue = self.active_connections.get(websocket)
+        if queue:
+            await queue.put(message)
 
-    async def broadcast(self, message: str):
-        for connection in self.active_connections:
+    async def broadcast(self, message: Union[str, bytes]):
+        slow_connections = []
+        for websocket, queue in self.active_connections.items():
             try:
-                await connection.send_text(message)
-            except:
-                pass
+                queue.put_nowait(message)
+            except asyncio.QueueFull:
+                slow_connections.append(websocket)
+
+        # A client that has fallen a full outbox behind is dropped rather than
+        # buffered without bound. It is likely not reading, so its close
+        # handshake runs on its own instead of holding up this broadcast.
+        for websocket in slow_connections:
+            self.disconnect(websocket)
+            closer = asyncio.create_task(self._close(websocket, 1013))
+            self.closers.add(closer)
+            closer.add_done_callback(self.closers.discard)
 
 manager = ConnectionManager()
 
+# Background batching
+async def drain_batch(queue: asyncio.Queue, max_items: int, max_wait: float) -> list:
+    """Wait for one item, then keep collecting until max_items or max_wait."""
+    batch = [await queue.get()]
+    deadline = asyncio.get_running_loop().time() + max_wait
+    while len(batch) < max_items:
+        timeout = deadline - asyncio.get_running_loop().time()
+        if timeout <= 0:
+            break
+        try:
+            batch.append(await asyncio.wait_for(queue.get(), timeout))
+        except asyncio.TimeoutError:
+            break
+    return batch
+
+async def stop_worker(task: asyncio.Task, queue: asyncio.Queue, timeout: float = 10):
+    """Give a batching worker a chance to flush its queue, then cancel it."""
+    try:
+        await asyncio.wait_for(queue.join(), timeout)
+    except asyncio.TimeoutError:
+        logging.error(f"Shutting down with {queue.qsize()} queued items unflushed")
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+
+async def save_record(audit_record: AuditRecord) -> AuditRecord:
+    """Queue a record for the next batched commit and wait until it is stored."""
+    future = asyncio.get_running_loop().create_future()
+    await db_write_queue.put((audit_record, future))
+    return await future
+
+async def insert_records(records: List[AuditRecord]):
+    # One transaction for all of them; the INSERTs are sent as a multi-row
+    # statement with RETURNING so every record gets its id.
+    async with SessionLocal() as db:
+        db.add_all(records)
+        await db.commit()
+
+def fail_batch(batch: list, error: Exception):
+    for _, future in batch:
+        if not future.done():
+            future.set_exception(error)
+
+async def write_batch(batch: list):
+    try:
+        await insert_records([record for record, _ in batch])
+    except (IntegrityError, DataError) as e:
+        if len(batch) == 1 or e.connection_invalidated:
+            fail_batch(batch, e)
+            return
+        # A row was rejected (a duplicate transaction hash, or a NUL byte
+        # Postgres refuses in text or jsonb). Retry the records one by one so
+        # only the offending request fails, not everything queued alongside it.
+        for item in batch:
+            await write_batch([item])
+        return
+    except Exception as e:
+        # Connection and other batch-wide failures would fail every retry
+        # too, each one possibly waiting out the connect timeout.
+        fail_batch(batch, e)
+        return
+    for record, future in batch:
+        if not future.done():
+            future.set_result(record)
+
+async def db_write_worker():
+    while True:
+        batch = await drain_batch(db_write_queue, max_items=500, max_wait=0.05)
+        try:
+            await write_batch(batch)
+        finally:
+            for _ in batch:
+                db_write_queue.task_done()
+
+async def add_to_ipfs(data: dict) -> str:
+    """Queue a JSON document for the next IPFS add and wait for its CID."""
+    future = asyncio.get_running_loop().create_future()
+    await ipfs_add_queue.put((orjson.dumps(data), future))
+    return await future
+
+async def ipfs_add_worker():
+    while True:
+        batch = await drain_batch(ipfs_add_queue, max_items=100, max_wait=0.02)
+        try:
+            # One add request carries the whole batch as separate files, named
+            # by position so each CID in the response can be matched back.
+            files = [("file", (str(i), content, "application/json")) for i, (content, _) in enumerate(batch)]
+            response = await ipfs_client.post(
+                "/api/v0/add",
+                params={"cid-version": 1, "raw-leaves": "true"},
+                files=files
+            )
+            response.raise_for_status()
+            cids = {}
+            for line in response.text.splitlines():
+                entry = orjson.loads(line)
+                cids[entry["Name"]] = entry["Hash"]
+            for i, (_, future) in enumerate(batch):
+                if not future.done():
+                    future.set_result(cids[str(i)])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            for _ in batch:
+                ipfs_add_queue.task_done()
+
+async def configure_audit_index():
+    # Documents arrive in bulk and searches tolerate some lag, so skip the
+    # per-request translog fsync and refresh far less often than the 1s default.
+    settings = {"index": {"translog.durability": "async", "refresh_interval": "30s"}}
+    if await es.indices.exists(index="audit_records"):
+        await es.indices.put_settings(index="audit_records", settings=settings)
+    else:
+        # Map id up front: searches sort on it and must not fail on a fresh,
+        # still-empty index
+        await es.indices.create(
+            index="audit_records",
+            settings=settings,
+            mappings={"properties": {"id": {"type": "long"}}}
+        )
+    await store_search_template()
+
+async def bulk_index_worker():
+    while True:
+        actions = await drain_batch(es_index_queue, max_items=500, max_wait=0.2)
+        try:
+            _, errors = await async_bulk(es, actions, raise_on_error=False)
+            if errors:
+                logging.error(f"Elasticsearch indexing failed for {len(errors)} documents: {errors[0]}")
+        except Exception as e:
+            logging.error(f"Elasticsearch bulk indexing failed: {e}")
+        finally:
+            for _ in actions:
+                es_index_queue.task_done()
+
+def on_kafka_delivery(future: asyncio.Future):
+    if not future.cancelled() and future.exception():
+        logging.error(f"Kafka publish failed: {future.exception()}")
+
+async def publish_event(audit_record: AuditRecord, metadata: orjson.Fragment):
+    if not kafka_producer:
+        return
+    try:
+        kafka_data = {
+            "id": audit_record.id,
+            "event_type": audit_record.event_type,
+            "user_id": audit_record.user_id,
+            "action": audit_record.action,
+            "timestamp": audit_record.timestamp,
+            "ipfs_hash": audit_record.ipfs_hash,
+            "metadata": metadata
+        }
+        # send() only enqueues into the current batch; delivery is
+        # reported through the returned future.
+        delivery = await kafka_producer.send('audit-events', orjson.dumps(kafka_data))
+        delivery.add_done_callback(on_kafka_delivery)
+    except Exception as e:
+        logging.error(f"Kafka publish failed: {e}")
+
+def index_action(audit_record: AuditRecord) -> dict:
+    return {
+        "_op_type": "index",
+        "_index": "audit_records",
+        "_id": audit_record.id,
+        "_source": {
+            "id": audit_record.id,
+            "event_type": audit_record.event_type,
+            "user_id": audit_record.user_id,
+            "action": audit_record.action,
+            "timestamp": audit_record.timestamp,
+            "ipfs_hash": audit_record.ipfs_hash
+        }
+    }
+
+async def index_event(audit_record: AuditRecord):
+    if not es:
+        return
+    # The record is already committed, so a backed-up index must not hold up
+    # the request; /admin/reindex backfills anything dropped here.
+    try:
+        es_index_queue.put_nowait(index_action(audit_record))
+    except asyncio.QueueFull:
+        logging.error(f"Elasticsearch index queue full, dropping record {audit_record.id}")
+
+async def broadcast_event(audit_record: AuditRecord):
+    # Encoded once and sent as a binary frame, so no client pays for its own
+    # str -> UTF-8 conversion.
+    message = orjson.dumps({
+        "type": "new_event",
+        "data": {
+            "id": audit_record.id,
+            "event_type": audit_record.event_type,
+            "user_id": audit_record.user_id,
+            "action": audit_record.action,
+            "timestamp": audit_record.timestamp
+        }
+    })
+    # Clients are spread across workers, so go through the bus; each worker's
+    # relay then delivers to the sockets it holds.
+    if broadcast_bus:
+        try:
+            await broadcast_bus.publish(BROADCAST_CHANNEL, message)
+            return
+        except Exception as e:
+            logging.error(f"Broadcast publish failed: {e}")
+    await manager.broadcast(message)
+
+async def relay_broadcasts():
+    while True:
+        try:
+            async with broadcast_bus.pubsub() as pubsub:
+                await pubsub.subscribe(BROADCAST_CHANNEL)
+                async for message in pubsub.listen():
+                    if message["type"] == "message":
+                        await manager.broadcast(message["data"])
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Broadcast relay failed, resubscribing: {e}")
+            await asyncio.sleep(1)
+
+# Service health
+HEALTH_CHECK_INTERVAL = 5
+
+# Refreshed in the background so /health never waits on a remote service
+service_status: Dict[str, bool] = {
+    "database": True,
+    "kafka": False,
+    "elasticsearch": False,
+    "ethereum": False,
+    "ipfs": False
+}
+
+async def check_ethereum() -> bool:
+    if not w3:
+        return False
+    try:
+        return await asyncio.to_thread(w3.is_connected)
+    except Exception:
+        return False
+
+async def check_elasticsearch() -> bool:
+    if not es:
+        return False
+    try:
+        return await es.ping()
+    except Exception:
+        return False
+
+async def check_ipfs() -> bool:
+    if not ipfs_client:
+        return False
+    try:
+        response = await ipfs_client.post("/api/v0/version")
+        return response.is_success
+    except Exception:
+        return False
+
+async def update_service_status():
+    ethereum, elasticsearch, ipfs = await asyncio.gather(
+        check_ethereum(), check_elasticsearch(), check_ipfs()
+    )
+    service_status.update({
+        "kafka": kafka_producer is not None,
+        "elasticsearch": elasticsearch,
+        "ethereum": ethereum,
+        "ipfs": ipfs
+    })
+
+async def refresh_service_status():
+    while True:
+        await asyncio.sleep(HEALTH_CHECK_INTERVAL)
+        await update_service_status()
+
 # Routes
 @app.get("/")
 async def root():
@@ -194,91 +686,54 @@ async def root():
 
 @app.get("/health")
 async def health_check():
-    services = {
-        "database": True,
-        "kafka": kafka_producer is not None,
-        "elasticsearch": es is not None,
-        "ethereum": w3 is not None and w3.isConnected() if w3 else False,
-        "ipfs": ipfs_client is not None
-    }
-    
     return {
-        "status": "healthy" if all(services.values()) else "degraded",
-        "services": services,
+        "status": "healthy" if all(service_status.values()) else "degraded",
+        "services": service_status,
         "timestamp": datetime.utcnow()
     }
 
 @app.post("/events", response_model=dict)
-async def create_event(event: EventModel, db: Session = Depends(get_db)):
+async def create_event(event: EventModel):
     try:
+        # Metadata is the only unbounded part of an event; encode it once and
+        # embed the bytes as-is in both the IPFS and Kafka payloads.
+        metadata_json = orjson.Fragment(dumps_json(event.metadata))
+
         # Store in IPFS
         ipfs_hash = None
-        if ipfs_client:
+        if service_status["ipfs"]:
             try:
-                event_data = event.dict()
-                ipfs_result = ipfs_client.add_json(event_data)
-                ipfs_hash = ipfs_result
+                event_data = {
+                    "event_type": event.event_type,
+                    "user_id": event.user_id,
+                    "action": event.action,
+                    "metadata": metadata_json
+                }
+                ipfs_hash = await add_to_ipfs(event_data)
             except Exception as e:
                 logging.error(f"IPFS storage failed: {e}")
 
         # Create audit record
-        audit_record = AuditRecord(
+        audit_record = await save_record(AuditRecord(
             event_type=event.event_type,
             user_id=event.user_id,
             action=event.action,
             ipfs_hash=ipfs_hash,
-            metadata=json.dumps(event.metadata)
+            metadata_=event.metadata
+        ))
+
+        # Kafka, Elasticsearch and WebSocket delivery are independent of each
+        # other, so run them concurrently. A failing sink must not fail the
+        # request (the record is already stored), but it is still logged.
+        results = await asyncio.gather(
+            publish_event(audit_record, metadata_json),
+            index_event(audit_record),
+            broadcast_event(audit_record),
+            return_exceptions=True
         )
-        
-        db.add(audit_record)
-        db.commit()
-        db.refresh(audit_record)
-
-        # Send to Kafka
-        if kafka_producer:
-            try:
-                kafka_data = {
-                    "id": audit_record.id,
-                    "event_type": event.event_type,
-                    "user_id": event.user_id,
-                    "action": event.action,
-                    "timestamp": audit_record.timestamp.isoformat(),
-                    "ipfs_hash": ipfs_hash,
-                    "metadata": event.metadata
-                }
-                kafka_producer.send('audit-events', kafka_data)
-            except Exception as e:
-                logging.error(f"Kafka publish failed: {e}")
-
-        # Index in Elasticsearch
-        if es:
-            try:
-                es.index(
-                    index="audit_records",
-                    id=audit_record.id,
-                    body={
-                        "id": audit_record.id,
-                        "event_type": event.event_type,
-                        "user_id": event.user_id,
-                        "action": event.action,
-                        "timestamp": audit_record.timestamp,
-                        "ipfs_hash": ipfs_hash
-                    }
-                )
-            except Exception as e:
-                logging.error(f"Elasticsearch indexing failed: {e}")
-
-        # Broadcast to WebSocket connections
-        await manager.broadcast(json.dumps({
-            "type": "new_event",
-            "data": {
-                "id": audit_record.id,
-                "event_type": event.event_type,
-                "user_id": event.user_id,
-                "action": event.action,
-                "timestamp": audit_record.timestamp.isoformat()
-            }
-        }))
+        for sink, result in zip(("Kafka publish", "Elasticsearch indexing", "WebSocket broadcast"), results):
+            if isinstance(result, Exception):
+                logging.error(f"{sink} failed: {result}")
 
         return {
             "success": True,
@@ -291,82 +746,180 @@ async def create_event(event: EventModel, db: Session = Depends(get_db)):
         logging.error(f"Event creation failed: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.get("/audit/records", response_model=List[AuditRecordResponse])
+# Columns filled by /events/bulk; everything else is left NULL
+BULK_COPY_COLUMNS = ["event_type", "user_id", "action", "timestamp", "verified", "metadata"]
+
+@app.post("/events/bulk", response_model=dict)
+async def create_events_bulk(events: List[EventModel]):
+    # Initial loads and replays go straight to Postgres with a binary COPY,
+    # bypassing the ORM. They are not stored in IPFS, published to Kafka or
+    # broadcast; run /admin/reindex afterwards to make them searchable.
+    if not events:
+        return {"success": True, "count": 0}
+
+    now = datetime.utcnow()
+    # The jsonb codec the engine installs on its connections takes JSON text
+    rows = [
+        (event.event_type, event.user_id, event.action, now, False, dumps_json(event.metadata).decode())
+        for event in events
+    ]
+
+    try:
+        async with engine.connect() as conn:
+            raw_connection = await conn.get_raw_connection()
+            await raw_connection.driver_connection.copy_records_to_table(
+                "audit_records", records=rows, columns=BULK_COPY_COLUMNS
+            )
+    except Exception as e:
+        logging.error(f"Bulk event load failed: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+    return {"success": True, "count": len(rows)}
+
+@app.get(
+    "/audit/records",
+    response_model=None,
+    responses={200: {"model": List[AuditRecordResponse]}}
+)
 async def get_audit_records(
     limit: int = 50,
     event_type: Optional[str] = None,
     user_id: Optional[str] = None,
-    db: Session = Depends(get_db)
+    before_timestamp: Optional[datetime] = None,
+    before_id: Optional[int] = None,
+    db: AsyncSession = Depends(get_db)
 ):
-    query = db.query(AuditRecord)
+    # Pass the timestamp and id of the last record on a page to get the next one
+    try:
+        before = keyset_cursor(before_timestamp, before_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    query = select(*RESPONSE_COLUMNS)
     
     if event_type:
-        query = query.filter(AuditRecord.event_type == event_type)
+        query = query.where(AuditRecord.event_type == event_type)
     if user_id:
-        query = query.filter(AuditRecord.user_id == user_id)
+        query = query.where(AuditRecord.user_id == user_id)
     
-    records = query.order_by(AuditRecord.timestamp.desc()).limit(limit).all()
-    return [AuditRecordResponse(**record.__dict__) for record in records]
+    result = await db.execute(newest_first(query, before).limit(limit))
+    # Rows come straight from typed columns, so encode them directly rather
+    # than building models that response_model would dump and re-validate.
+    # The declared schema is kept for the OpenAPI docs via responses=.
+    return ORJSONResponse([dict(row._mapping) for row in result])
 
 @app.get("/audit/search")
-async def search_audit_records(q: str, limit: int = 50):
+async def search_audit_records(
+    q: str,
+    limit: int = QueryParam(50, ge=1),
+    after_score: Optional[float] = None,
+    after_id: Optional[int] = None
+):
     if not es:
         raise HTTPException(status_code=503, detail="Elasticsearch not available")
+    # Pass back the next_page values from a previous response to continue
+    if (after_score is None) != (after_id is None):
+        raise HTTPException(status_code=400, detail="after_score and after_id must be given together")
+    search_after = [after_score, after_id] if after_id is not None else None
     
     try:
-        response = es.search(
-            index="audit_records",
-            body={
-                "query": {
-                    "multi_match": {
-                        "query": q,
-                        "fields": ["event_type", "user_id", "action"]
-                    }
-                },
-                "size": limit
-            }
-        )
+        hits = await search_audit_index(q, limit, search_after)
         
         results = []
-        for hit in response['hits']['hits']:
+        for hit in hits:
             results.append(hit['_source'])
         
-        return {"results": results, "total": response['hits']['total']['value']}
+        next_page = None
+        if hits and len(hits) == limit:
+            score, record_id = hits[-1]['sort']
+            next_page = {"after_score": score, "after_id": record_id}
+        
+        return {"results": results, "next_page": next_page}
     
     except Exception as e:
         logging.error(f"Search failed: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/admin/reindex")
+async def reindex_audit_records(concurrency: int = QueryParam(12, ge=1, le=64), db: AsyncSession = Depends(get_db)):
+    if not es:
+        raise HTTPException(status_code=503, detail="Elasticsearch not available")
+
+    # A single writer leaves most of the cluster's indexing threads idle, so
+    # keep up to `concurrency` bulk requests in flight. The semaphore is taken
+    # before the next chunk is read, which also bounds how many rows are held.
+    semaphore = asyncio.Semaphore(concurrency)
+    tasks = []
+    indexed = 0
+    failed = 0
+
+    async def index_chunk(actions: list):
+        nonlocal indexed, failed
+        try:
+            success, errors = await async_bulk(es, actions, raise_on_error=False)
+            indexed += success
+            failed += len(errors)
+        except Exception as e:
+            logging.error(f"Elasticsearch reindex chunk failed: {e}")
+            failed += len(actions)
+        finally:
+            semaphore.release()
+
+    try:
+        result = await db.stream(
+            select(AuditRecord).execution_options(yield_per=10_000)
+        )
+        partitions = result.scalars().partitions()
+        while True:
+            await semaphore.acquire()
+            records = await anext(partitions, None)
+            if records is None:
+                semaphore.release()
+                break
+            tasks.append(asyncio.create_task(index_chunk([index_action(r) for r in records])))
+        await asyncio.gather(*tasks)
+    except Exception as e:
+        logging.error(f"Reindex failed: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+    return {"success": failed == 0, "indexed": indexed, "failed": failed}
+
+def read_chain_status() -> dict:
+    # Each of these is a blocking JSON-RPC round trip
+    latest_block = w3.eth.get_block('latest')
+    return {
+        "connected": w3.is_connected(),
+        "latest_block": latest_block.number,
+        "network_id": w3.net.version,
+        "gas_price": w3.eth.gas_price,
+        "accounts": len(w3.eth.accounts)
+    }
+
 @app.get("/blockchain/status")
 async def blockchain_status():
     if not w3:
         raise HTTPException(status_code=503, detail="Ethereum node not available")
     
     try:
-        latest_block = w3.eth.get_block('latest')
-        return {
-            "connected": w3.isConnected(),
-            "latest_block": latest_block.number,
-            "network_id": w3.net.version,
-            "gas_price": w3.eth.gas_price,
-            "accounts": len(w3.eth.accounts)
-        }
+        return await asyncio.to_thread(read_chain_status)
     except Exception as e:
         logging.error(f"Blockchain status check failed: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/ipfs/status")
 async def ipfs_status():
-    if not ipfs_client:
-        raise HTTPException(status_code=503, detail="IPFS not available")
-    
     try:
-        version_info = ipfs_client.version()
+        response = await ipfs_client.post("/api/v0/version")
+        response.raise_for_status()
+        version_info = response.json()
         return {
             "connected": True,
             "version": version_info['Version'],
             "protocol_version": version_info['Protocol']
         }
+    except httpx.TransportError as e:
+        logging.error(f"IPFS status check failed: {e}")
+        raise HTTPException(status_code=503, detail="IPFS not available")
     except Exception as e:
         logging.error(f"IPFS status check failed: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -387,4 +940,11 @@ app.include_router(graphql_app, prefix="/graphql")
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        loop="uvloop",
+        http="httptools",
+        workers=int(os.getenv("WEB_CONCURRENCY", os.cpu_count()))
+    )
\ No newline at end of file
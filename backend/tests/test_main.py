@@ -0,0 +1,573 @@
+import asyncio
+import json
+import re
+import threading
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import httpx
+import orjson
+import pytest
+from sqlalchemy import select
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import DataError, OperationalError
+
+import main
+from main import AuditRecord, ConnectionManager
+
+
+class FakeSession:
+    """Stands in for an AsyncSession; commit fails if any record is marked bad or down."""
+
+    def __init__(self, commits: list):
+        self.commits = commits
+        self.records = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    def add_all(self, records):
+        self.records.extend(records)
+
+    async def commit(self):
+        actions = {record.action for record in self.records}
+        if "down" in actions:
+            raise OperationalError("INSERT", None, OSError("connection refused"))
+        if "bad" in actions:
+            raise DataError("INSERT", None, ValueError("invalid byte sequence"))
+        for record in self.records:
+            record.id = len(self.commits) + 1000
+        self.commits.append(list(self.records))
+
+
+class FakeWebSocket:
+    def __init__(self, fail_sends: bool = False, block_sends: bool = False, block_close: bool = False):
+        self.fail_sends = fail_sends
+        self.block_sends = block_sends
+        self.block_close = block_close
+        self.accepted = False
+        self.sent = []
+        self.close_code = None
+        self.unblock = asyncio.Event()
+
+    async def accept(self):
+        self.accepted = True
+
+    async def _send(self, message):
+        if self.fail_sends:
+            raise RuntimeError("connection reset")
+        if self.block_sends:
+            await self.unblock.wait()
+        self.sent.append(message)
+
+    async def send_bytes(self, data: bytes):
+        await self._send(data)
+
+    async def send_text(self, data: str):
+        await self._send(data)
+
+    async def close(self, code: int = 1000):
+        self.close_code = code
+        if self.block_close:
+            await self.unblock.wait()
+
+
+class FakeStreamSession:
+    """Streams pre-built partitions of records, counting how many were read."""
+
+    def __init__(self, chunks: list):
+        self.chunks = chunks
+        self.read = 0
+
+    async def stream(self, statement):
+        return self
+
+    def scalars(self):
+        return self
+
+    async def _partitions(self):
+        for chunk in self.chunks:
+            self.read += 1
+            yield chunk
+
+    def partitions(self):
+        return self._partitions()
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+@pytest.fixture
+def db_session(monkeypatch):
+    commits = []
+    monkeypatch.setattr(main, "SessionLocal", lambda: FakeSession(commits))
+    monkeypatch.setattr(main, "db_write_queue", asyncio.Queue(maxsize=10000))
+    return commits
+
+
+@pytest.fixture
+def ipfs_requests(monkeypatch):
+    requests = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        names = re.findall(rb'filename="(\d+)"', request.read())
+        # Answer out of order so CIDs have to be matched by name, not position
+        lines = [orjson.dumps({"Name": name.decode(), "Hash": f"cid-{name.decode()}"}) for name in reversed(names)]
+        return httpx.Response(200, content=b"\n".join(lines))
+
+    monkeypatch.setattr(main, "ipfs_client", httpx.AsyncClient(transport=httpx.MockTransport(handler), base_url="http://ipfs"))
+    monkeypatch.setattr(main, "ipfs_add_queue", asyncio.Queue(maxsize=10000))
+    return requests
+
+
+@pytest.fixture
+async def api_client():
+    # ASGITransport doesn't run the lifespan, so no services are contacted
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        yield client
+
+
+# drain_batch / stop_worker
+
+async def test_drain_batch_stops_at_max_items():
+    queue = asyncio.Queue()
+    for i in range(5):
+        queue.put_nowait(i)
+    assert await main.drain_batch(queue, max_items=3, max_wait=1) == [0, 1, 2]
+    assert queue.qsize() == 2
+
+
+async def test_drain_batch_returns_partial_batch_after_max_wait():
+    queue = asyncio.Queue()
+    queue.put_nowait("only")
+    assert await main.drain_batch(queue, max_items=10, max_wait=0.01) == ["only"]
+
+
+async def test_stop_worker_flushes_queue_before_cancelling():
+    queue = asyncio.Queue()
+    handled = []
+
+    async def worker():
+        while True:
+            item = await queue.get()
+            await asyncio.sleep(0)
+            handled.append(item)
+            queue.task_done()
+
+    for i in range(3):
+        queue.put_nowait(i)
+    task = asyncio.create_task(worker())
+    await main.stop_worker(task, queue)
+    assert handled == [0, 1, 2]
+    assert task.cancelled()
+
+
+async def test_stop_worker_cancels_after_timeout(caplog):
+    queue = asyncio.Queue()
+    queue.put_nowait("stuck")
+    task = asyncio.create_task(asyncio.Event().wait())
+    await main.stop_worker(task, queue, timeout=0.01)
+    assert task.cancelled()
+    assert "1 queued items unflushed" in caplog.text
+
+
+# Elasticsearch indexing
+
+async def test_index_event_drops_record_when_queue_is_full(monkeypatch, caplog):
+    monkeypatch.setattr(main, "es", object())
+    monkeypatch.setattr(main, "es_index_queue", asyncio.Queue(maxsize=1))
+    await main.index_event(AuditRecord(id=1, action="kept"))
+    await asyncio.wait_for(main.index_event(AuditRecord(id=2, action="dropped")), timeout=1)
+    assert main.es_index_queue.qsize() == 1
+    assert main.es_index_queue.get_nowait()["_id"] == 1
+    assert "dropping record 2" in caplog.text
+
+
+# Batched database writes
+
+async def test_db_write_worker_commits_queued_records_together(db_session):
+    task = asyncio.create_task(main.db_write_worker())
+    records = await asyncio.gather(*(main.save_record(AuditRecord(action=f"a{i}")) for i in range(3)))
+    await main.stop_worker(task, main.db_write_queue)
+    assert len(db_session) == 1
+    assert [record.action for record in db_session[0]] == ["a0", "a1", "a2"]
+    assert all(record.id is not None for record in records)
+
+
+async def test_write_batch_only_fails_the_rejected_record(db_session):
+    loop = asyncio.get_running_loop()
+    batch = [(AuditRecord(action=action), loop.create_future()) for action in ("ok", "bad", "ok")]
+    await main.write_batch(batch)
+    good, bad, other = (future for _, future in batch)
+    assert good.result().action == "ok"
+    assert other.result().action == "ok"
+    with pytest.raises(DataError):
+        bad.result()
+    # The failed multi-row commit is followed by one commit per good record
+    assert [len(commit) for commit in db_session] == [1, 1]
+
+
+async def test_write_batch_fails_whole_batch_on_connection_error(db_session):
+    loop = asyncio.get_running_loop()
+    batch = [(AuditRecord(action=action), loop.create_future()) for action in ("ok", "down", "ok")]
+    await main.write_batch(batch)
+    # Retried alone, the good records would have committed
+    for _, future in batch:
+        with pytest.raises(OperationalError):
+            future.result()
+    assert db_session == []
+
+
+async def test_write_batch_does_not_split_on_invalidated_connection(db_session, monkeypatch):
+    error = DataError("INSERT", None, ValueError("server closed the connection"), connection_invalidated=True)
+    attempts = []
+
+    async def insert_records(records):
+        attempts.append(len(records))
+        raise error
+
+    monkeypatch.setattr(main, "insert_records", insert_records)
+    loop = asyncio.get_running_loop()
+    batch = [(AuditRecord(action="ok"), loop.create_future()) for _ in range(3)]
+    await main.write_batch(batch)
+    assert all(future.exception() is error for _, future in batch)
+    assert attempts == [3]
+
+
+# Batched IPFS adds
+
+async def test_ipfs_add_worker_matches_cids_by_file_name(ipfs_requests):
+    task = asyncio.create_task(main.ipfs_add_worker())
+    cids = await asyncio.gather(*(main.add_to_ipfs({"n": i}) for i in range(3)))
+    await main.stop_worker(task, main.ipfs_add_queue)
+    assert cids == ["cid-0", "cid-1", "cid-2"]
+    assert len(ipfs_requests) == 1
+    assert ipfs_requests[0].url.path == "/api/v0/add"
+
+
+async def test_ipfs_add_worker_fails_whole_batch_on_http_error(monkeypatch):
+    transport = httpx.MockTransport(lambda request: httpx.Response(500))
+    monkeypatch.setattr(main, "ipfs_client", httpx.AsyncClient(transport=transport, base_url="http://ipfs"))
+    monkeypatch.setattr(main, "ipfs_add_queue", asyncio.Queue(maxsize=10000))
+    task = asyncio.create_task(main.ipfs_add_worker())
+    results = await asyncio.gather(main.add_to_ipfs({}), main.add_to_ipfs({}), return_exceptions=True)
+    await main.stop_worker(task, main.ipfs_add_queue)
+    assert all(isinstance(result, httpx.HTTPStatusError) for result in results)
+
+
+# ConnectionManager
+
+async def test_broadcast_sends_bytes_and_text_frames():
+    manager = ConnectionManager()
+    websocket = FakeWebSocket()
+    await manager.connect(websocket)
+    await manager.broadcast(b'{"type":"new_event"}')
+    await manager.send_personal_message("Echo: hi", websocket)
+    await settle()
+    assert websocket.accepted
+    assert websocket.sent == [b'{"type":"new_event"}', "Echo: hi"]
+    manager.disconnect(websocket)
+
+
+async def test_broadcast_drops_client_with_full_outbox():
+    manager = ConnectionManager(max_queued_messages=1)
+    slow, fast = FakeWebSocket(block_sends=True), FakeWebSocket()
+    await manager.connect(slow)
+    await manager.connect(fast)
+    await manager.broadcast("first")
+    await settle()
+    await manager.broadcast("second")
+    await settle()
+    await manager.broadcast("third")
+    await settle()
+    assert slow not in manager.active_connections
+    assert slow not in manager.writers
+    assert slow.close_code == 1013
+    assert fast.sent == ["first", "second", "third"]
+    manager.disconnect(fast)
+
+
+async def test_broadcast_does_not_wait_for_close_handshake():
+    manager = ConnectionManager(max_queued_messages=1)
+    stuck = FakeWebSocket(block_sends=True, block_close=True)
+    await manager.connect(stuck)
+    await manager.broadcast("first")
+    await settle()
+    await manager.broadcast("second")
+    # The client never answers the close, but dropping it must not block
+    await asyncio.wait_for(manager.broadcast("third"), timeout=1)
+    await settle()
+    assert stuck not in manager.active_connections
+    assert stuck.close_code == 1013
+    assert len(manager.closers) == 1
+    stuck.unblock.set()
+    await settle()
+    assert manager.closers == set()
+
+
+async def test_failed_send_disconnects_client():
+    manager = ConnectionManager()
+    websocket = FakeWebSocket(fail_sends=True)
+    await manager.connect(websocket)
+    await manager.broadcast("hello")
+    await settle()
+    assert websocket not in manager.active_connections
+    assert websocket not in manager.writers
+
+
+async def test_disconnect_cancels_writer():
+    manager = ConnectionManager()
+    websocket = FakeWebSocket()
+    await manager.connect(websocket)
+    writer = manager.writers[websocket]
+    manager.disconnect(websocket)
+    await settle()
+    assert writer.cancelled()
+    assert manager.active_connections == {}
+    # A second disconnect (e.g. from the endpoint after a send failure) is harmless
+    manager.disconnect(websocket)
+
+
+# Blockchain status
+
+async def test_blockchain_status_reads_the_node_off_the_event_loop(monkeypatch):
+    loop_thread = threading.get_ident()
+    rpc_threads = []
+
+    def get_block(block_id):
+        rpc_threads.append(threading.get_ident())
+        return SimpleNamespace(number=42)
+
+    eth = SimpleNamespace(get_block=get_block, gas_price=7, accounts=["0xa", "0xb"])
+    w3 = SimpleNamespace(eth=eth, net=SimpleNamespace(version="1337"), is_connected=lambda: True)
+    monkeypatch.setattr(main, "w3", w3)
+    assert await main.blockchain_status() == {
+        "connected": True,
+        "latest_block": 42,
+        "network_id": "1337",
+        "gas_price": 7,
+        "accounts": 2,
+    }
+    assert rpc_threads and loop_thread not in rpc_threads
+
+
+# Keyset pagination
+
+def test_keyset_cursor_requires_both_values():
+    with pytest.raises(ValueError):
+        main.keyset_cursor(datetime(2026, 1, 1), None)
+    with pytest.raises(ValueError):
+        main.keyset_cursor(None, 5)
+    assert main.keyset_cursor(None, None) is None
+
+
+def test_keyset_cursor_normalizes_aware_timestamps_to_naive_utc():
+    aware = datetime(2026, 1, 1, 12, 0, tzinfo=timezone(timedelta(hours=2)))
+    assert main.keyset_cursor(aware, 7) == (datetime(2026, 1, 1, 10, 0), 7)
+    naive = datetime(2026, 1, 1, 12, 0)
+    assert main.keyset_cursor(naive, 7) == (naive, 7)
+
+
+def compile_sql(query) -> str:
+    return str(query.compile(dialect=postgresql.dialect()))
+
+
+def test_newest_first_orders_by_timestamp_then_id():
+    sql = compile_sql(main.newest_first(select(AuditRecord.id)))
+    assert "WHERE" not in sql
+    assert sql.endswith("ORDER BY audit_records.timestamp DESC, audit_records.id DESC")
+
+
+def test_newest_first_applies_cursor_as_row_comparison():
+    sql = compile_sql(main.newest_first(select(AuditRecord.id), (datetime(2026, 1, 1), 7)))
+    assert "WHERE (audit_records.timestamp, audit_records.id) < (" in sql
+
+
+# Event fan-out
+
+async def test_create_event_logs_failed_sinks_and_still_succeeds(monkeypatch, caplog):
+    async def save_record(audit_record):
+        audit_record.id = 1
+        return audit_record
+
+    async def failing_publish(audit_record, metadata):
+        raise RuntimeError("broker unreachable")
+
+    async def failing_broadcast(audit_record):
+        raise RuntimeError("redis unreachable")
+
+    async def index_event(audit_record):
+        pass
+
+    monkeypatch.setitem(main.service_status, "ipfs", False)
+    monkeypatch.setattr(main, "save_record", save_record)
+    monkeypatch.setattr(main, "publish_event", failing_publish)
+    monkeypatch.setattr(main, "index_event", index_event)
+    monkeypatch.setattr(main, "broadcast_event", failing_broadcast)
+    response = await main.create_event(main.EventModel(event_type="login", user_id="u1", action="sign in"))
+    assert response["success"] is True
+    assert response["id"] == 1
+    assert "Kafka publish failed: broker unreachable" in caplog.text
+    assert "WebSocket broadcast failed: redis unreachable" in caplog.text
+    assert "Elasticsearch indexing failed" not in caplog.text
+
+
+# Reindexing
+
+async def test_reindex_bounds_bulk_requests_in_flight(monkeypatch):
+    session = FakeStreamSession([[AuditRecord(id=p * 10 + i) for i in range(3)] for p in range(5)])
+    in_flight = []
+    peak = 0
+    completed = 0
+    unfinished = []
+
+    async def async_bulk(client, actions, raise_on_error):
+        nonlocal peak, completed
+        in_flight.append(actions)
+        peak = max(peak, len(in_flight))
+        # Partitions are only read once a slot is free
+        unfinished.append(session.read - completed)
+        await asyncio.sleep(0.01)
+        in_flight.remove(actions)
+        completed += 1
+        if actions[0]["_id"] == 20:
+            raise RuntimeError("bulk rejected")
+        return len(actions), []
+
+    monkeypatch.setattr(main, "es", object())
+    monkeypatch.setattr(main, "async_bulk", async_bulk)
+    response = await main.reindex_audit_records(concurrency=2, db=session)
+    assert response == {"success": False, "indexed": 12, "failed": 3}
+    assert peak == 2
+    assert max(unfinished) <= 2
+
+
+@pytest.mark.parametrize("concurrency", [0, -1, 65])
+async def test_reindex_rejects_out_of_range_concurrency(api_client, monkeypatch, concurrency):
+    monkeypatch.setattr(main, "es", object())
+    monkeypatch.setitem(main.app.dependency_overrides, main.get_db, lambda: FakeStreamSession([]))
+    response = await api_client.post("/admin/reindex", params={"concurrency": concurrency})
+    assert response.status_code == 422
+
+
+# Audit search
+
+@pytest.fixture
+def search_calls(monkeypatch):
+    calls = []
+
+    async def search_audit_index(query, size, search_after=None):
+        calls.append((query, size, search_after))
+        return [{"_source": {"id": 9 - i}, "sort": [1.5, 9 - i]} for i in range(min(size, 3))]
+
+    monkeypatch.setattr(main, "es", object())
+    monkeypatch.setattr(main, "search_audit_index", search_audit_index)
+    return calls
+
+
+async def test_search_returns_next_page_for_a_full_page(search_calls):
+    response = await main.search_audit_records(q="login", limit=2, after_score=2.0, after_id=11)
+    assert response == {"results": [{"id": 9}, {"id": 8}], "next_page": {"after_score": 1.5, "after_id": 8}}
+    assert search_calls == [("login", 2, [2.0, 11])]
+
+
+async def test_search_has_no_next_page_for_a_short_page(search_calls):
+    response = await main.search_audit_records(q="login", limit=10, after_score=None, after_id=None)
+    assert len(response["results"]) == 3
+    assert response["next_page"] is None
+    assert search_calls == [("login", 10, None)]
+
+
+async def test_search_handles_an_empty_page(search_calls):
+    # len([]) == limit must not reach hits[-1]
+    response = await main.search_audit_records(q="login", limit=0, after_score=None, after_id=None)
+    assert response == {"results": [], "next_page": None}
+
+
+async def test_search_rejects_limit_zero(api_client, search_calls):
+    response = await api_client.get("/audit/search", params={"q": "login", "limit": 0})
+    assert response.status_code == 422
+    assert search_calls == []
+
+
+@pytest.mark.parametrize("params", [{"after_score": 1.5}, {"after_id": 8}])
+async def test_search_requires_after_score_and_after_id_together(api_client, search_calls, params):
+    response = await api_client.get("/audit/search", params={"q": "login", **params})
+    assert response.status_code == 400
+    assert search_calls == []
+
+
+# JSON encoding
+
+def test_dumps_json_matches_orjson_for_ordinary_documents():
+    document = {"amount": 10, "tags": ["a", "b"], "nested": {"ok": True}}
+    assert main.dumps_json(document) == orjson.dumps(document)
+
+
+def test_dumps_json_encodes_integers_beyond_64_bits():
+    big = 2**64 + 1
+    encoded = main.dumps_json({"wei": big})
+    assert json.loads(encoded) == {"wei": big}
+    # The fallback output still embeds cleanly in an orjson payload
+    assert json.loads(orjson.dumps({"metadata": orjson.Fragment(encoded)})) == {"metadata": {"wei": big}}
+
+
+# Bulk ingestion
+
+class FakeCopyEngine:
+    """Records copy_records_to_table calls made through engine.connect()."""
+
+    def __init__(self):
+        self.connections = 0
+        self.copies = []
+
+    def connect(self):
+        self.connections += 1
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def get_raw_connection(self):
+        return SimpleNamespace(driver_connection=self)
+
+    async def copy_records_to_table(self, table, records, columns):
+        self.copies.append((table, list(records), columns))
+
+
+@pytest.fixture
+def copy_engine(monkeypatch):
+    engine = FakeCopyEngine()
+    monkeypatch.setattr(main, "engine", engine)
+    return engine
+
+
+async def test_bulk_copies_one_row_per_event(copy_engine):
+    events = [
+        main.EventModel(event_type="login", user_id="u1", action="sign in", metadata={"wei": 2**64 + 1}),
+        main.EventModel(event_type="logout", user_id="u2", action="sign out"),
+    ]
+    assert await main.create_events_bulk(events) == {"success": True, "count": 2}
+    [(table, rows, columns)] = copy_engine.copies
+    assert table == "audit_records"
+    assert columns == main.BULK_COPY_COLUMNS
+    assert [row[:3] for row in rows] == [("login", "u1", "sign in"), ("logout", "u2", "sign out")]
+    # One load time for the whole batch, never verified, metadata as JSON text
+    assert rows[0][3] == rows[1][3]
+    assert [row[4] for row in rows] == [False, False]
+    assert [json.loads(row[5]) for row in rows] == [{"wei": 2**64 + 1}, {}]
+
+
+async def test_bulk_with_no_events_skips_the_database(copy_engine):
+    assert await main.create_events_bulk([]) == {"success": True, "count": 0}
+    assert copy_engine.connections == 0
@@ -0,0 +1,4 @@
+-- Keyset pagination for the audit record listing endpoints
+-- (WHERE (timestamp, id) < (:ts, :id) ORDER BY timestamp DESC, id DESC)
+
+CREATE INDEX IF NOT EXISTS ix_audit_records_ts_id ON audit_records(timestamp DESC, id DESC);
@@ -0,0 +1,16 @@
+-- Composite indexes for the filtered audit record listings
+-- (WHERE user_id = ... / event_type = ... ORDER BY timestamp DESC, id DESC)
+
+CREATE INDEX IF NOT EXISTS ix_audit_user_ts ON audit_records(user_id, timestamp DESC, id DESC);
+CREATE INDEX IF NOT EXISTS ix_audit_etype_ts ON audit_records(event_type, timestamp DESC, id DESC);
+
+-- Equality lookups on user_id / event_type are covered by the leading column above
+DROP INDEX IF EXISTS idx_audit_records_user_id;
+DROP INDEX IF EXISTS idx_audit_records_event_type;
+
+-- Transaction hashes identify a single on-chain record
+CREATE UNIQUE INDEX IF NOT EXISTS ix_audit_records_transaction_hash ON audit_records(transaction_hash);
+DROP INDEX IF EXISTS idx_audit_records_transaction_hash;
+
+-- Timestamp range scans are covered by ix_audit_records_ts_id (timestamp DESC, id DESC)
+DROP INDEX IF EXISTS idx_audit_records_timestamp;